@@ -9,7 +9,7 @@ which python3
 python3 -m pip install torch torchvision torchaudio --index-url https://download.pytorch.org/whl/cu118
 python3 -m pip install nltk nlpaug numpy pandas
 
-python3 -m pip install urllib3 tabulate
+python3 -m pip install urllib3 tabulate orjson
 python3 -m pip install ./downloads/libsource/transformers
 python3 -m pip install scipy==1.10.1 dill
 python3 -m pip install accelerate -U
@@ -1,6 +1,10 @@
+import os
 import torch
 import torch.nn as nn
 import torch.optim as optim
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 
@@ -14,105 +18,181 @@ class SimpleModel(nn.Module):
         x = torch.relu(self.fc1(x))
         return self.fc2(x)
 
-def compute_variance_online(gradients):
-    n = 0
-    mean = None
-    M2 = None
+@torch.compile(fullgraph=True)
+def noise_inject_step(grad, variance, noise, scale):
+    # grad += noise * sqrt(var) * scale, fused by Inductor into one elementwise kernel
+    return grad.addcmul_(noise, variance.sqrt() * scale)
+
+class AGNIAdamW(optim.AdamW):
+    """
+    AdamW with adaptive gradient noise injection.
+
+    Call step() after every backward pass. Each call updates a running Welford
+    estimate of the gradient variance; every `gradient_accumulation_steps` calls
+    noise scaled by sqrt(eta * variance) * |grad| is added to the gradients
+    before the AdamW update is applied.
+
+    Gradients live in a single flat buffer and every p.grad must stay a view
+    into it: zero_grad(set_to_none=True) is not supported, and step() raises if
+    a gradient was set to None (e.g. by model.zero_grad()) or reassigned.
+    """
+    def __init__(self, params, gradient_accumulation_steps=4, eta=0.01, **kwargs):
+        super().__init__(params, **kwargs)
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.eta = eta
+        self.micro_steps = 0
+
+        # All gradients live in one flat buffer; each p.grad is a view into it, so
+        # backward accumulates in place and the statistics below run as single kernels.
+        # This state is kept outside self.state, which AdamW initialises lazily.
+        params = [p for group in self.param_groups for p in group['params']]
+        self.grad_flat = _flatten_dense_tensors([torch.zeros_like(p) for p in params])
+        for p, g in zip(params, _unflatten_dense_tensors(self.grad_flat, params)):
+            p.grad = g
+        self.params = params
+        self.grad_ptrs = [p.grad.data_ptr() for p in params]
+        # Index of the owning parameter for every element of grad_flat
+        numels = torch.tensor([p.numel() for p in params], device=self.grad_flat.device)
+        segments = torch.arange(len(params), device=self.grad_flat.device)
+        self.segment_ids = torch.repeat_interleave(segments, numels)
+        self.num_segments = len(params)
+
+        # Running Welford state (count, mean, M2) over the flat gradient
+        self.count = 0
+        self.mean = torch.zeros_like(self.grad_flat)
+        self.M2 = torch.zeros_like(self.grad_flat)
+
+    def grad_norms(self):
+        # Per-parameter L2 norms of the flat gradient, in one segmented reduction
+        squares = self.grad_flat.new_zeros(self.num_segments)
+        return squares.index_add_(0, self.segment_ids, self.grad_flat.square()).sqrt_()
+
+    def check_grads(self):
+        # The statistics below only see grad_flat; a gradient that no longer aliases
+        # it would be updated by AdamW but silently ignored by the noise injection
+        for p, ptr in zip(self.params, self.grad_ptrs):
+            if p.grad is None or p.grad.data_ptr() != ptr:
+                raise RuntimeError(
+                    "AGNIAdamW requires every p.grad to stay a view into its flat gradient buffer; "
+                    "use optimizer.zero_grad() instead of model.zero_grad() or set_to_none=True"
+                )
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        self.check_grads()
+        grad_flat, mean, M2 = self.grad_flat, self.mean, self.M2
+
+        # Update running gradient statistics
+        self.count += 1
+        delta = grad_flat - mean
+        mean.add_(delta / self.count)
+        M2.addcmul_(delta, grad_flat - mean)
+
+        self.micro_steps += 1
+        if self.micro_steps % self.gradient_accumulation_steps != 0:
+            return None
+
+        # Compute gradient variance and reset the buffers in place for the next cycle
+        gradient_variance = M2 / (self.count - 1) if self.count > 1 else M2.clone()
+        self.count = 0
+        mean.zero_()
+        M2.zero_()
+
+        # Scale noise by each parameter's gradient magnitude: grad += randn * sqrt(eta * var) * |grad|
+        scale = self.grad_norms()[self.segment_ids] * (self.eta ** 0.5)
+        noise_inject_step(grad_flat, gradient_variance, torch.randn_like(grad_flat), scale)
+
+        return super().step(closure)
+
+    def zero_grad(self, set_to_none=False):
+        # Zero the flat buffer in place so that p.grad stays a view into it
+        if set_to_none:
+            raise ValueError("AGNIAdamW does not support zero_grad(set_to_none=True)")
+        self.grad_flat.zero_()
+
+class Experiment:
+    def __init__(self, use_noise_injection, seed, gradient_accumulation_steps=4, eta=0.01, device='cpu'):
+        # Seed before construction so that every experiment starts from the same weights
+        torch.manual_seed(seed)
+        self.model = SimpleModel().to(device)
+        self.params = list(self.model.parameters())
+        if use_noise_injection:
+            self.optimizer = AGNIAdamW(self.params, gradient_accumulation_steps, eta, lr=1e-3)
+        else:
+            self.optimizer = optim.AdamW(self.params, lr=1e-3)
+        self.criterion = nn.MSELoss()
+        self.use_noise_injection = use_noise_injection
+        self.gradient_accumulation_steps = gradient_accumulation_steps
+        self.effective_step_sizes = []
+
+    def step(self, epoch, x, y):
+        # Forward pass
+        output = self.model(x)
+        loss = self.criterion(output, y)
 
-    for grad in gradients:
-        grad_np = grad.cpu().numpy()
-        if mean is None:
-            mean = np.zeros_like(grad_np)
-            M2 = np.zeros_like(grad_np)
+        # Backward pass
+        loss = loss / self.gradient_accumulation_steps
+        loss.backward()
 
-        n += 1
-        delta = grad_np - mean
-        mean += delta / n
-        delta2 = grad_np - mean
-        M2 += delta * delta2
+        # AGNIAdamW tracks gradient statistics on every call and only injects
+        # noise and updates the weights on accumulation boundaries
+        boundary = (epoch + 1) % self.gradient_accumulation_steps == 0
+        if boundary or self.use_noise_injection:
+            self.optimizer.step()
 
-    variance = M2 / (n - 1) if n > 1 else M2
-    return torch.from_numpy(variance).float().to(gradients[0].device)
+        if boundary:
+            # Compute effective step size (sum of per-parameter step norms, one host sync);
+            # the AdamW update leaves p.grad untouched
+            grad_norms = torch.stack(torch._foreach_norm([p.grad for p in self.params]))
+            effective_step = (self.optimizer.param_groups[0]['lr'] * grad_norms.sum()).item()
+            self.effective_step_sizes.append(effective_step)
 
-def run_experiment(use_noise_injection, num_epochs=1000, gradient_accumulation_steps=4, eta=0.01):
-    model = SimpleModel()
-    optimizer = optim.AdamW(model.parameters(), lr=1e-3)
-    criterion = nn.MSELoss()
+            # AGNIAdamW zeroes its flat gradient buffer in place
+            self.optimizer.zero_grad(set_to_none=not self.use_noise_injection)
 
-    gradient_dict = {p: [] for p in model.parameters()}
-    effective_step_sizes = []
+def run_both(num_epochs=1000, gradient_accumulation_steps=4, eta=0.01, seed=0, device=None):
+    # Keep models, data and gradient statistics on a single device
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    for epoch in range(num_epochs):
-        # Generate random input and target
-        x = torch.randn(32, 10)
-        y = torch.randn(32, 1)
+    # Generate random inputs and targets for all epochs up front, shared by both experiments
+    xs = torch.randn(num_epochs, 32, 10, device=device)
+    ys = torch.randn(num_epochs, 32, 1, device=device)
 
-        # Forward pass
-        output = model(x)
-        loss = criterion(output, y)
+    adamw = Experiment(False, seed, gradient_accumulation_steps, eta, device)
+    noise_injection = Experiment(True, seed, gradient_accumulation_steps, eta, device)
 
-        # Backward pass
-        loss = loss / gradient_accumulation_steps
-        loss.backward()
-
-        # Collect gradients
-        for p in model.parameters():
-            if p.grad is not None:
-                gradient_dict[p].append(p.grad.view(-1).detach())
-
-        if (epoch + 1) % gradient_accumulation_steps == 0:
-            if use_noise_injection:
-                # Compute gradient variance and inject noise
-                for p in model.parameters():
-                    if p.grad is not None:
-                        gradient_variance = compute_variance_online(gradient_dict[p])
-                        gradient_dict[p] = []
-
-                        # Compute gradient magnitude
-                        grad_magnitude = torch.norm(p.grad)
-
-                        # Scale noise based on gradient magnitude
-                        noise_scale = torch.sqrt(eta * gradient_variance.view(p.grad.shape)) * grad_magnitude
-                        noise = torch.randn_like(p.grad) * noise_scale
-
-                        # Inject noise
-                        p.grad += noise
-
-            # Compute effective step size
-            effective_step = 0
-            for p in model.parameters():
-                if p.grad is not None:
-                    effective_step += (optimizer.param_groups[0]['lr'] * p.grad.norm()).item()
-            effective_step_sizes.append(effective_step)
-
-            # Optimizer step
-            optimizer.step()
-            optimizer.zero_grad()
-
-    return effective_step_sizes
-
-# Run experiments
-adamw_steps = run_experiment(use_noise_injection=False)
-noise_injection_steps = run_experiment(use_noise_injection=True)
-
-# Plot results
-plt.figure(figsize=(10, 6))
-plt.plot(adamw_steps, label='AdamW')
-plt.plot(noise_injection_steps, label='AdamW with Noise Injection')
-plt.xlabel('Gradient Updates')
-plt.ylabel('Effective Step Size')
-plt.title('Comparison of Effective Step Sizes')
-plt.legend()
-plt.yscale('log')
-plt.grid(True)
-plt.savefig('effective_step_sizes.png')
-plt.close()
-
-# Compute statistics
-adamw_mean = np.mean(adamw_steps)
-adamw_std = np.std(adamw_steps)
-noise_mean = np.mean(noise_injection_steps)
-noise_std = np.std(noise_injection_steps)
-
-print(f"AdamW - Mean: {adamw_mean:.4f}, Std: {adamw_std:.4f}")
-print(f"Noise Injection - Mean: {noise_mean:.4f}, Std: {noise_std:.4f}")
+    for epoch in range(num_epochs):
+        x = xs[epoch]
+        y = ys[epoch]
+        adamw.step(epoch, x, y)
+        noise_injection.step(epoch, x, y)
+
+    return adamw.effective_step_sizes, noise_injection.effective_step_sizes
+
+if __name__ == '__main__':
+    # Run experiments
+    adamw_steps, noise_injection_steps = run_both()
+
+    if os.environ.get('PLOT', '1') == '1':
+        # Plot results
+        plt.figure(figsize=(10, 6))
+        plt.plot(adamw_steps, label='AdamW')
+        plt.plot(noise_injection_steps, label='AdamW with Noise Injection')
+        plt.xlabel('Gradient Updates')
+        plt.ylabel('Effective Step Size')
+        plt.title('Comparison of Effective Step Sizes')
+        plt.legend()
+        plt.yscale('log')
+        plt.grid(True)
+        plt.savefig('effective_step_sizes.png')
+        plt.close()
+
+    # Compute statistics
+    adamw_mean = np.mean(adamw_steps)
+    adamw_std = np.std(adamw_steps)
+    noise_mean = np.mean(noise_injection_steps)
+    noise_std = np.std(noise_injection_steps)
+
+    print(f"AdamW - Mean: {adamw_mean:.4f}, Std: {adamw_std:.4f}")
+    print(f"Noise Injection - Mean: {noise_mean:.4f}, Std: {noise_std:.4f}")
@@ -2,35 +2,86 @@ import json
 import os
 import argparse
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
-def check_and_fix_json_files(directory, fix=False):
+# orjson parses bytes in C and is much faster than the stdlib parser; its
+# JSONDecodeError subclasses json.JSONDecodeError so error handling is shared
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+def parse(data):
+    try:
+        return loads(data)
+    except json.JSONDecodeError:
+        if loads is json.loads:
+            raise
+        # orjson rejects the NaN/Infinity literals json.dump writes by default
+        # (e.g. a NaN pearson score), so only the stdlib parser decides a file is broken
+        return json.loads(data)
+
+def tail(f, n, block_size=64):
+    # Last n non-whitespace bytes of the file, reading backwards block by block
+    # so any amount of trailing whitespace is skipped
+    pos = f.seek(0, os.SEEK_END)
+    content = b''
+    while pos > 0 and len(content) < n:
+        start = max(pos - block_size, 0)
+        f.seek(start)
+        content = b''.join(f.read(pos - start).split()) + content
+        pos = start
+    return content[-n:]
+
+def validate(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            # Only files ending in '}}' can have an extra trailing '}', so check the
+            # tail first and skip the full parse for everything else
+            if not tail(f, 2).endswith(b'}}'):
+                return file_path, None
+            f.seek(0)
+            parse(f.read())
+    except json.JSONDecodeError as e:
+        return file_path, e
+    return file_path, None
+
+def check_and_fix_json_files(directory, fix=False, max_workers=8):
+    # Collect candidate files first, then validate them in parallel
+    paths = []
     for root, dirs, files in os.walk(directory):
         for file in files:
             if file.endswith('.json') and not file.startswith('broken_'):
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, 'r') as f:
-                        json.load(f)
-                except json.JSONDecodeError as e:
-                    if "Extra data" in str(e):
-                        with open(file_path, 'r') as f:
-                            content = f.read().strip()
-                        
-                        if content.endswith('}') and content.count('}') > content.count('{'):
-                            print(f"File with trailing '}}': {file_path}")
-                            
-                            if fix:
-                                # Create a backup
-                                backup_path = os.path.join(root, f"broken_{file}")
-                                shutil.copy2(file_path, backup_path)
-                                
-                                # Fix the file
-                                fixed_content = content.rstrip('}')
-                                with open(file_path, 'w') as f:
-                                    f.write(fixed_content)
-                                print(f"  Fixed and backup created: {backup_path}")
-                            else:
-                                print("  Use --fix=y to fix this file")
+                paths.append(os.path.join(root, file))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        results = list(ex.map(validate, paths))
+
+    # Fixes are applied serially from the main thread
+    for file_path, e in results:
+        # The trailing-'}' check below is done on the content itself, so it does
+        # not depend on the parser's error message
+        if e is not None:
+            root, file = os.path.split(file_path)
+            with open(file_path, 'r') as f:
+                content = f.read().strip()
+            
+            if content.endswith('}') and content.count('}') > content.count('{'):
+                print(f"File with trailing '}}': {file_path}")
+                
+                if fix:
+                    # Create a backup
+                    backup_path = os.path.join(root, f"broken_{file}")
+                    shutil.copy2(file_path, backup_path)
+                    
+                    # Fix the file
+                    fixed_content = content.rstrip('}')
+                    with open(file_path, 'w') as f:
+                        f.write(fixed_content)
+                    print(f"  Fixed and backup created: {backup_path}")
+                else:
+                    print("  Use --fix=y to fix this file")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Check and optionally fix JSON files with trailing '}'")
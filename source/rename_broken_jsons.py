@@ -1,22 +1,54 @@
 import os
 import json
+from concurrent.futures import ThreadPoolExecutor
 
-def process_json_files(directory):
+# Use orjson for parsing when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+def parse(data):
+    try:
+        return loads(data)
+    except json.JSONDecodeError:
+        if loads is json.loads:
+            raise
+        # orjson rejects the NaN/Infinity literals json.dump writes by default
+        # (e.g. a NaN pearson score), so only the stdlib parser decides a file is broken
+        return json.loads(data)
+
+def validate(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            parse(f.read())
+        #print(f"Successfully loaded: {file_path}")
+    except Exception as e:
+        return file_path, e
+    return file_path, None
+
+def process_json_files(directory, max_workers=8):
+    # Collect candidate files first, then validate them in parallel
+    paths = []
     for root, dirs, files in os.walk(directory):
         for file in files:
             if file.endswith('.json') and not file.startswith('broken_'):
-                file_path = os.path.join(root, file)
-                try:
-                    with open(file_path, 'r') as f:
-                        json.load(f)
-                    #print(f"Successfully loaded: {file_path}")
-                except json.JSONDecodeError:
-                    new_name = f"broken_{file}"
-                    new_path = os.path.join(root, new_name)
-                    os.rename(file_path, new_path)
-                    print(f"Renamed {file_path} to {new_path}")
-                except Exception as e:
-                    print(f"Error processing {file_path}: {str(e)}")
+                paths.append(os.path.join(root, file))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        results = list(ex.map(validate, paths))
+
+    # Renames are applied serially from the main thread
+    for file_path, e in results:
+        if isinstance(e, json.JSONDecodeError):
+            root, file = os.path.split(file_path)
+            new_name = f"broken_{file}"
+            new_path = os.path.join(root, new_name)
+            os.rename(file_path, new_path)
+            print(f"Renamed {file_path} to {new_path}")
+        elif e is not None:
+            print(f"Error processing {file_path}: {str(e)}")
 
 # Specify the directory path
 saves_directory = "./saves"
@@ -13,23 +13,29 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """Finetuning a 🤗 Transformers model for sequence classification on GLUE."""
+import contextlib
 import copy
 import argparse
+import fcntl
 import json
 import logging
 import math
 import os
 import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pathlib
 
 import datasets
 import evaluate
+import numpy as np
 import torch
 import torch.nn as nn
-from accelerate import Accelerator
+from accelerate import Accelerator, DistributedDataParallelKwargs
+from accelerate.checkpointing import save_accelerator_state, save_custom_state
 from accelerate.logging import get_logger
-from accelerate.utils import set_seed
+from accelerate.utils import AutocastKwargs, DataLoaderConfiguration, GradientAccumulationPlugin, set_seed
 from datasets import load_dataset
 from huggingface_hub import HfApi
 from torch.utils.data import DataLoader
@@ -46,6 +52,7 @@ from transformers import (
     default_data_collator,
     get_scheduler,
 )
+from transformers.trainer_pt_utils import LengthGroupedSampler
 from transformers.utils import check_min_version, send_example_telemetry
 from transformers.utils.versions import require_version
 
@@ -107,7 +114,7 @@ def parse_args():
     parser.add_argument(
         "--use_slow_tokenizer",
         action="store_true",
-        help="If passed, will use a slow tokenizer (not backed by the 🤗 Tokenizers library).",
+        help="Not supported: tokenization relies on a fast tokenizer (backed by the 🤗 Tokenizers library).",
     )
     parser.add_argument(
         "--per_device_train_batch_size",
@@ -211,6 +218,66 @@ def parse_args():
         type=str,
         default='y'
     )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="auto",
+        choices=["auto", "no", "fp16", "bf16"],
+        help=(
+            "Mixed precision mode. `auto` uses bf16 on GPUs that support it, fp16 on other GPUs and full precision"
+            " on CPU."
+        ),
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help=(
+            "Whether to compile the ensemble forward with `torch.compile`. Batches are then always padded to"
+            " `max_length` to keep shapes static."
+        ),
+    )
+    parser.add_argument(
+        "--select_layers",
+        type=int,
+        nargs="*",
+        default=[],
+        help=(
+            "Layers whose attention maps are decorrelated across ensemble members. Attentions are only returned by"
+            " the members when at least one layer is selected."
+        ),
+    )
+    parser.add_argument(
+        "--auto_scale",
+        action="store_true",
+        help=(
+            "Whether to adapt to the number of processes: the learning rate is scaled linearly with the world size,"
+            " an explicit `--max_train_steps` is divided by it so the number of samples seen stays the same, and"
+            " the learning rate is warmed up over at least 5% of training."
+        ),
+    )
+    parser.add_argument(
+        "--cuda_graphs",
+        action="store_true",
+        help=(
+            "Whether to capture forward, backward and optimizer step of a training step into a CUDA graph and replay"
+            " it. Batches are then always padded to `max_length`. Requires a single CUDA device, no gradient"
+            " accumulation, no fp16 and no `--select_layers`."
+        ),
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help=(
+            "Whether to group training samples of similar length into the same batch, which reduces padding when"
+            " dynamic padding is used."
+        ),
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=4,
+        help="Number of worker processes used to collate batches. Use 0 to load in the main process.",
+    )
     args = parser.parse_args()
 
     # Sanity checks
@@ -224,6 +291,17 @@ def parse_args():
             extension = args.validation_file.split(".")[-1]
             assert extension in ["csv", "json"], "`validation_file` should be a csv or a json file."
 
+    if args.use_slow_tokenizer:
+        raise ValueError("`--use_slow_tokenizer` is not supported, tokenization requires a fast tokenizer.")
+
+    if args.cuda_graphs:
+        if args.compile:
+            raise ValueError("`--cuda_graphs` and `--compile` cannot be used together.")
+        if args.gradient_accumulation_steps != 1:
+            raise ValueError("`--cuda_graphs` does not support gradient accumulation.")
+        if len(args.select_layers) > 0:
+            raise ValueError("`--cuda_graphs` does not support `--select_layers`.")
+
     if args.push_to_hub:
         assert args.output_dir is not None, "Need an `output_dir` to create a repo when `--push_to_hub` is passed."
 
@@ -232,9 +310,9 @@ def parse_args():
 import torch.nn.functional as F
 from torch.nn import BCEWithLogitsLoss, CrossEntropyLoss, MSELoss
 
-class PerturbedEnsembleModel(nn.Module):
-    def __init__(self, models,config):
-        super(PerturbedEnsembleModel, self).__init__()
+class EnsembleModel(nn.Module):
+    def __init__(self, models,config, return_attentions=False):
+        super(EnsembleModel, self).__init__()
         # Initialize the list of member BERT models
         self.members = nn.ModuleList(models)
         self.config = config
@@ -242,67 +320,89 @@ class PerturbedEnsembleModel(nn.Module):
         # Initialize weights for each model
         num_models = len(models)
         self.weights = nn.Parameter(torch.ones(num_models) / num_models)
-        # Perturb the 0th member's weights
-        self.perturb_member(self.members[0], epsilon=0.1)
-    def perturb_member(self, model, epsilon=0.01):
-        """
-        Add Gaussian noise to all trainable weights of the given model.
-        
-        Args:
-            model (nn.Module): The model to perturb.
-            epsilon (float): The standard deviation of the Gaussian noise.
-        """
-        for param in model.parameters():
-            if param.requires_grad:
-                noise = torch.randn(param.size()) * epsilon
-                param.data += noise
+        # Fix the problem type once so forward does not have to infer it from the labels. GLUE labels are
+        # integer class ids (or a single float score for regression), so multi-label is never inferred here.
+        if self.config.problem_type is None:
+            self.config.problem_type = "regression" if self.num_labels == 1 else "single_label_classification"
+        self.loss_fns = nn.ModuleDict({
+            "regression": MSELoss(),
+            "single_label_classification": CrossEntropyLoss(),
+            "multi_label_classification": BCEWithLogitsLoss(),
+        })
+        # Attention maps are only materialized when a caller needs them
+        self.return_attentions = return_attentions
+        # One CUDA stream per member so that the member forwards can overlap on the GPU. The streams are created
+        # lazily on the device of the inputs; with `use_streams` off every member runs on the current stream.
+        self.use_streams = True
+        self.streams = None
+
+    def member_streams(self, device):
+        if self.streams is None or self.streams[0].device != device:
+            self.streams = [torch.cuda.Stream(device=device) for _ in self.members]
+        return self.streams
 
     def forward(
         self,
-        batch
+        input_ids,
+        attention_mask,
+        token_type_ids=None,
+        labels=None
     ):
-        outputs = []
+        # Unpack the member inputs once; labels stay here since the loss is computed on the combined logits
+        member_inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:
+            member_inputs["token_type_ids"] = token_type_ids
+
+        raw_logits = []
         attentions = []
-        # Use enumerate to get both the index and model directly
-        for index, model in enumerate(self.members):
-            output = model(
-                **batch,
-                output_attentions=True,
-                output_hidden_states=True
-            )
-            # Multiply model output (logits) with its respective weight
-           
-            
-            weighted_output = output.logits * self.weights[index]
-            outputs.append(weighted_output)
-            attentions.append(output.attentions)
-        # Sum all weighted outputs
-        combined_logits = torch.sum(torch.stack(outputs), dim=0)
+        # Decided per call from the inputs, so CPU runs on a CUDA host never touch CUDA streams
+        # Dynamo breaks the graph at stream switches and record_stream, so traced forwards stay on one stream
+        use_streams = self.use_streams and input_ids.is_cuda and not torch.compiler.is_compiling()
+        if use_streams:
+            main_stream = torch.cuda.current_stream(input_ids.device)
+            streams = self.member_streams(input_ids.device)
+        else:
+            streams = [None] * len(self.members)
+        for model, stream in zip(self.members, streams):
+            if stream is not None:
+                # The member stream must see the inputs produced on the main stream
+                stream.wait_stream(main_stream)
+                stream_context = torch.cuda.stream(stream)
+            else:
+                stream_context = contextlib.nullcontext()
+            with stream_context:
+                output = model(
+                    **member_inputs,
+                    output_attentions=self.return_attentions,
+                    output_hidden_states=False
+                )
+            if stream is not None:
+                # These tensors are consumed on the main stream once the members finish
+                output.logits.record_stream(main_stream)
+                if self.return_attentions:
+                    for attention in output.attentions:
+                        attention.record_stream(main_stream)
+            raw_logits.append(output.logits)
+            if self.return_attentions:
+                attentions.append(output.attentions)
+        if use_streams:
+            for stream in streams:
+                main_stream.wait_stream(stream)
+        # Weighted sum of the member logits in one kernel: [M] x [M, B, C] -> [B, C]
+        combined_logits = torch.einsum('m,mbc->bc', self.weights, torch.stack(raw_logits, dim=0))
         # Calculate loss if labels are provided
         
-        labels = batch['labels']
-
         loss = None
         if labels is not None:
-            if self.config.problem_type is None:
-                if self.num_labels == 1:
-                    self.config.problem_type = "regression"
-                elif self.num_labels > 1 and (labels.dtype == torch.long or labels.dtype == torch.int):
-                    self.config.problem_type = "single_label_classification"
-                else:
-                    self.config.problem_type = "multi_label_classification"
-
+            loss_fct = self.loss_fns[self.config.problem_type]
             if self.config.problem_type == "regression":
-                loss_fct = MSELoss()
                 if self.num_labels == 1:
                     loss = loss_fct(combined_logits.squeeze(), labels.squeeze())
                 else:
                     loss = loss_fct(combined_logits, labels)
             elif self.config.problem_type == "single_label_classification":
-                loss_fct = CrossEntropyLoss()
                 loss = loss_fct(combined_logits.view(-1, self.num_labels), labels.view(-1))
             elif self.config.problem_type == "multi_label_classification":
-                loss_fct = BCEWithLogitsLoss()
                 loss = loss_fct(combined_logits, labels)
         
         return {
@@ -313,81 +413,29 @@ class PerturbedEnsembleModel(nn.Module):
 
 
 
-class EnsembleModel(nn.Module):
-    def __init__(self, models,config):
-        super(EnsembleModel, self).__init__()
-        # Initialize the list of member BERT models
-        self.members = nn.ModuleList(models)
-        self.config = config
-        self.num_labels = config.num_labels
-        # Initialize weights for each model
-        num_models = len(models)
-        self.weights = nn.Parameter(torch.ones(num_models) / num_models)
-
-    def forward(
-        self,
-        batch
-    ):
-        outputs = []
-        attentions = []
-        # Use enumerate to get both the index and model directly
-        for index, model in enumerate(self.members):
-            output = model(
-                **batch,
-                output_attentions=True,
-                output_hidden_states=True
-            )
-            # Multiply model output (logits) with its respective weight
-           
-            
-            weighted_output = output.logits * self.weights[index]
-            outputs.append(weighted_output)
-            attentions.append(output.attentions)
-        # Sum all weighted outputs
-        combined_logits = torch.sum(torch.stack(outputs), dim=0)
-        # Calculate loss if labels are provided
-        
-        labels = batch['labels']
-
-        loss = None
-        if labels is not None:
-            if self.config.problem_type is None:
-                if self.num_labels == 1:
-                    self.config.problem_type = "regression"
-                elif self.num_labels > 1 and (labels.dtype == torch.long or labels.dtype == torch.int):
-                    self.config.problem_type = "single_label_classification"
-                else:
-                    self.config.problem_type = "multi_label_classification"
-
-            if self.config.problem_type == "regression":
-                loss_fct = MSELoss()
-                if self.num_labels == 1:
-                    loss = loss_fct(combined_logits.squeeze(), labels.squeeze())
-                else:
-                    loss = loss_fct(combined_logits, labels)
-            elif self.config.problem_type == "single_label_classification":
-                loss_fct = CrossEntropyLoss()
-                loss = loss_fct(combined_logits.view(-1, self.num_labels), labels.view(-1))
-            elif self.config.problem_type == "multi_label_classification":
-                loss_fct = BCEWithLogitsLoss()
-                loss = loss_fct(combined_logits, labels)
+class PerturbedEnsembleModel(EnsembleModel):
+    def __init__(self, models,config, return_attentions=False):
+        super(PerturbedEnsembleModel, self).__init__(models, config, return_attentions)
+        # Perturb the 0th member's weights
+        self.perturb_member(self.members[0], epsilon=0.1)
+    def perturb_member(self, model, epsilon=0.01):
+        """
+        Add Gaussian noise to all trainable weights of the given model.
         
-        return {
-                'loss' : loss,
-                'combined_logits' : combined_logits,
-                'attentions' : attentions
-        }
+        Args:
+            model (nn.Module): The model to perturb.
+            epsilon (float): The standard deviation of the Gaussian noise.
+        """
+        for param in model.parameters():
+            if param.requires_grad:
+                # Sample on the parameter's device and dtype, no host-to-device copy
+                param.data.add_(torch.randn_like(param), alpha=epsilon)
 
 
 
 def cosine_similarity(x, y):
-    # Normalize x and y to have unit norm
-    x_norm = F.normalize(x, p=2, dim=1)
-    y_norm = F.normalize(y, p=2, dim=1)
-    # Cosine similarity
-    cosine_sim = torch.sum(x_norm * y_norm, dim=1)
-    # Dissimilarity is 1 minus similarity
-    return cosine_simi
+    # Cosine similarity along dim 1, computed by a single fused kernel
+    return F.cosine_similarity(x, y, dim=1)
 
 def n_cosine_similarity(tensor_list):
     # Flatten and normalize each tensor in the list
@@ -399,22 +447,31 @@ def n_cosine_similarity(tensor_list):
     # Compute cosine similarity between all pairs using matrix multiplication
     similarity_matrix = torch.mm(all_tensors, all_tensors.t())
     
-    # Extract indices for each tensor
-    indices = torch.cumsum(torch.tensor([0] + [tensor.size(0) for tensor in tensor_list]), dim=0)
-    
-    # Initialize an empty list to store results
-    similarities = []
-    
-    # Extract similarities for each unique pair of tensors
-    for i in range(len(tensor_list)):
-        for j in range(i + 1, len(tensor_list)):  # Adjusted to get only unique pairs
-            sim = similarity_matrix[indices[i]:indices[i+1], indices[j]:indices[j+1]]
-            similarities.append(sim)
+    # Block id of every row/column; pairs from distinct tensors i < j lie strictly above the block diagonal
+    sizes = torch.tensor([tensor.size(0) for tensor in tensor_list], device=all_tensors.device)
+    block_ids = torch.repeat_interleave(torch.arange(len(tensor_list), device=all_tensors.device), sizes)
+    mask = block_ids.unsqueeze(1) < block_ids.unsqueeze(0)
 
-    # Concatenate all pairwise similarities into a single tensor
-    result_tensor = torch.cat(similarities, dim=0)
+    # Gather all pairwise similarities in a single flat tensor
+    result_tensor = similarity_matrix.masked_select(mask)
 
     return result_tensor
+
+def ensemble_attention_similarity(attentions, select_layers):
+    # attentions[m][l] holds layer l of member m; stack the selected layers of every member as [L, M, B, D]
+    stacked = torch.stack([torch.stack([member[l] for member in attentions]) for l in select_layers]).flatten(3)
+    # Read the large attention maps in bf16, but accumulate norms and means in fp32
+    if stacked.is_cuda:
+        stacked = stacked.to(torch.bfloat16)
+    norms = torch.linalg.vector_norm(stacked, dim=-1, keepdim=True, dtype=torch.float32).clamp_min(1e-6)
+    normalized = stacked / norms.to(stacked.dtype)
+    # The mean cosine similarity over all row pairs of two members is the dot product of their mean rows,
+    # so one einsum over [L, M, D] covers every (layer, member pair) at once
+    centroids = normalized.mean(dim=2, dtype=torch.float32)
+    gram = torch.einsum('lmd,lkd->lmk', centroids, centroids)
+    i, j = torch.triu_indices(gram.size(1), gram.size(2), offset=1, device=gram.device)
+    # Mean similarity per selected layer, same as n_cosine_similarity(...).mean() for each layer
+    return gram[:, i, j].mean(dim=1)
 def kl_convergence(x, y):
     softmax_x = F.softmax(x, dim=1)
     softmax_y = F.softmax(y, dim=1)
@@ -472,13 +529,34 @@ class AdaBoostCombiner(nn.Module):
         return combined_logits / weights.sum()
 
 def get_gradient_norm(model):
-    total_norm = 0.0
-    for p in model.parameters():
-        if p.grad is not None:
-            param_norm = p.grad.data.norm(2)
-            total_norm += param_norm.item() ** 2
-    total_norm = total_norm ** 0.5
-    return total_norm
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if len(grads) == 0:
+        return 0.0
+    # Per-tensor norms in one foreach launch, then a single device->host sync
+    param_norms = torch._foreach_norm(grads, 2.0)
+    total_norm = torch.linalg.vector_norm(torch.stack(param_norms), 2)
+    return total_norm.item()
+def gather_eval_predictions(accelerator, logits_list, labels_list, num_samples, is_regression=False):
+    # Post-process all eval batches at once: one argmax and one gather instead of one per batch
+    logits = torch.cat(logits_list, 0)
+    predictions = logits.argmax(dim=-1) if not is_regression else logits.squeeze(-1)
+    references = torch.cat(labels_list, 0)
+    predictions, references = accelerator.gather((predictions, references))
+    # If we are in a multiprocess environment, the last batch has duplicates
+    if accelerator.num_processes > 1:
+        # The gather is laid out process by process; reorder it batch by batch, as the dataloader hands out
+        # batches, so the duplicates padding the last batch end up at the tail
+        batch_size = logits_list[0].shape[0]
+        predictions = predictions.view(accelerator.num_processes, -1, batch_size).transpose(0, 1).reshape(-1)
+        references = references.view(accelerator.num_processes, -1, batch_size).transpose(0, 1).reshape(-1)
+        predictions = predictions[:num_samples]
+        references = references[:num_samples]
+    # Hand the metric numpy arrays: a single device->host copy instead of a per-element conversion inside
+    # `metric.add_batch`. numpy has no bf16, so regression outputs are upcast first.
+    if predictions.is_floating_point():
+        predictions = predictions.float()
+    return predictions.cpu().numpy(), references.cpu().numpy()
+
 def compute_with_retry(metric, max_retries=10, initial_wait=1):
     for attempt in range(max_retries):
         try:
@@ -493,10 +571,190 @@ def compute_with_retry(metric, max_retries=10, initial_wait=1):
     
     raise Exception(f"Failed to compute metric after {max_retries} attempts")
 
+class AsyncCheckpointer:
+    """
+    Writes training checkpoints from a background thread.
+
+    The model, optimizer, scheduler and scaler states are first copied to host memory (on a side CUDA stream when
+    available); a single worker thread then hands them to Accelerate's own `save_accelerator_state`, so training
+    continues while the checkpoint is on its way to disk and the layout stays the one `accelerator.load_state` /
+    `--resume_from_checkpoint` reads.
+    """
+    class Staged:
+        # Stands in for an optimizer/scheduler/scaler whose state was already copied to host memory
+        def __init__(self, state):
+            self.state = state
+
+        def state_dict(self):
+            return self.state
+
+    def __init__(self, accelerator):
+        self.accelerator = accelerator
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.stream = torch.cuda.Stream() if torch.cuda.is_available() else None
+
+    def stage(self, obj):
+        # Recursively copy tensors to (pinned) host memory, leaving other values as they are
+        if torch.is_tensor(obj):
+            if obj.device.type == "cuda":
+                staged = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=True)
+                return staged.copy_(obj, non_blocking=True)
+            return obj.detach().clone()
+        if isinstance(obj, dict):
+            return {k: self.stage(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.stage(v) for v in obj)
+        return copy.deepcopy(obj)
+
+    def save(self, output_dir, model, optimizer, lr_scheduler):
+        self.accelerator.wait_for_everyone()
+        # Keep a single checkpoint in flight
+        self.wait()
+
+        # Only the main process writes model/optimizer/scheduler/scaler files, so only it stages them
+        states = {"model": [], "optimizers": [], "schedulers": [], "scaler": None}
+        if self.accelerator.is_main_process:
+            states["model"] = [self.accelerator.get_state_dict(model, unwrap=False)]
+            states["optimizers"] = [optimizer.state_dict()]
+            states["schedulers"] = [lr_scheduler.state_dict()]
+            if self.accelerator.scaler is not None:
+                states["scaler"] = self.accelerator.scaler.state_dict()
+        states["custom"] = [obj.state_dict() for obj in self.accelerator._custom_objects]
+        # RNG states as of this step; the worker runs later, when training has moved the generators on
+        states["rng"] = {
+            "step": self.accelerator.step,
+            "random_state": random.getstate(),
+            "numpy_random_seed": np.random.get_state(),
+            "torch_manual_seed": torch.get_rng_state(),
+        }
+        if torch.cuda.is_available():
+            states["rng"]["torch_cuda_manual_seed"] = torch.cuda.get_rng_state_all()
+
+        done = None
+        if self.stream is not None:
+            # Copy on the side stream; the main stream waits for the copies before it can update the weights again
+            main_stream = torch.cuda.current_stream()
+            self.stream.wait_stream(main_stream)
+            with torch.cuda.stream(self.stream):
+                staged = self.stage(states)
+                done = torch.cuda.Event()
+                done.record()
+            main_stream.wait_stream(self.stream)
+        else:
+            staged = self.stage(states)
+
+        self.future = self.executor.submit(self.write, output_dir, staged, done)
+
+    def write(self, output_dir, staged, done):
+        if done is not None:
+            done.synchronize()
+        os.makedirs(output_dir, exist_ok=True)
+        save_accelerator_state(
+            output_dir,
+            model_states=staged["model"],
+            optimizers=[self.Staged(state) for state in staged["optimizers"]],
+            schedulers=[self.Staged(state) for state in staged["schedulers"]],
+            dataloaders=self.accelerator._dataloaders,
+            process_index=self.accelerator.process_index,
+            step=staged["rng"]["step"],
+            scaler=self.Staged(staged["scaler"]) if staged["scaler"] is not None else None,
+            save_on_each_node=self.accelerator.project_configuration.save_on_each_node,
+            safe_serialization=False,
+        )
+        for index, state in enumerate(staged["custom"]):
+            save_custom_state(self.Staged(state), output_dir, index)
+        # Replace the RNG states read in this thread with the ones taken when the checkpoint was requested
+        torch.save(
+            staged["rng"], os.path.join(output_dir, f"random_states_{self.accelerator.process_index}.pkl")
+        )
+
+    def wait(self, shutdown=False):
+        if self.future is not None:
+            self.future.result()
+            self.future = None
+        if shutdown:
+            self.executor.shutdown(wait=True)
+
+
+class CUDAGraphTrainStep:
+    """
+    Replays forward, backward and optimizer step of a training step as a single CUDA graph.
+
+    The first `warmup_steps` steps run eagerly on a side stream, as CUDA graph capture requires; the next step
+    is captured into the graph and every later step only copies its batch into the static input tensors and
+    replays the graph. Shapes must be static (batches padded to `max_length`, last incomplete batch dropped),
+    the optimizer must be capturable and gradients are never set to None between replays.
+    """
+    def __init__(self, accelerator, model, optimizer, warmup_steps=3):
+        self.accelerator = accelerator
+        self.model = model
+        self.optimizer = optimizer
+        self.warmup_steps = warmup_steps
+        self.steps = 0
+        self.stream = torch.cuda.Stream()
+        self.graph = None
+        self.static_batch = None
+        self.static_loss = None
+        self.lr_tensors = None
+
+    def train_step(self, batch):
+        loss = self.model(**batch)['loss']
+        self.accelerator.backward(loss)
+        self.optimizer.step()
+        return loss
+
+    def capture(self, batch):
+        # The learning rate is read from device tensors inside the graph, so scheduler updates still apply
+        self.lr_tensors = [
+            torch.tensor(float(group["lr"]), dtype=torch.float32, device=self.accelerator.device)
+            for group in self.optimizer.param_groups
+        ]
+        for group, lr in zip(self.optimizer.param_groups, self.lr_tensors):
+            group["lr"] = lr
+        self.static_batch = {k: v.clone() for k, v in batch.items()}
+        # Gradients are allocated from the graph's private pool and overwritten by every replay
+        self.optimizer.zero_grad(set_to_none=True)
+        self.graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(self.graph):
+            self.static_loss = self.train_step(self.static_batch)
+
+    def sync_lr(self):
+        # The scheduler writes plain floats into the param groups; move them into the captured tensors
+        for group, lr in zip(self.optimizer.param_groups, self.lr_tensors):
+            if group["lr"] is not lr:
+                lr.fill_(float(group["lr"]))
+                group["lr"] = lr
+
+    def __call__(self, batch):
+        if self.graph is None and self.steps < self.warmup_steps:
+            self.steps += 1
+            self.stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.stream):
+                self.optimizer.zero_grad(set_to_none=True)
+                loss = self.train_step(batch)
+            torch.cuda.current_stream().wait_stream(self.stream)
+            return loss.detach()
+
+        if self.graph is None:
+            # Capture only records the kernels, the replay below runs this step
+            self.capture(batch)
+        else:
+            for k, v in batch.items():
+                self.static_batch[k].copy_(v, non_blocking=True)
+            self.sync_lr()
+        self.graph.replay()
+        # The static loss is overwritten by the next replay, so hand out a copy
+        return self.static_loss.detach().clone()
+
+
 import uuid
 def main():
 
     args = parse_args()
+    # Let fp32 matmuls and convolutions use TF32 Tensor Cores on Ampere and newer GPUs
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
     folder_path = f"./saves/{args.job_id}" 
     pathlib.Path(folder_path).mkdir(exist_ok=True)
     eval_save_file_name = f'{folder_path}/results_rg_{args.task_name}_{args.model_name_or_path.split("/")[-1]}.json'
@@ -520,9 +778,54 @@ def main():
     model_path = os.path.join(save_dir, f"{model_name_short}_{args.task_name}_model")
     dataset_path = os.path.join(save_dir, f"dataset_{args.task_name}")
 
-    accelerator = (
-        Accelerator(log_with=args.report_to, project_dir=args.output_dir) if args.with_tracking else Accelerator()
+    # Accelerate handles gradient accumulation: the loss is scaled for us and, under DDP, gradients are only
+    # all-reduced on the last micro-batch of each accumulation cycle (see `accelerator.accumulate` below).
+    # Every ensemble parameter receives a gradient on every step, so DDP does not need to search the autograd
+    # graph for unused parameters and can treat the graph as static.
+    # Gradients are kept as views into the DDP all-reduce buckets, which avoids a second copy of every gradient.
+    ddp_kwargs = DistributedDataParallelKwargs(
+        find_unused_parameters=False, gradient_as_bucket_view=True, static_graph=True
     )
+    # Multi-GPU runs use one process per GPU, e.g.
+    #   torchrun --nproc_per_node=$NGPU source/run_glue_baselines2.py --model_name_or_path ... --task_name ...
+    # The process group is set up here explicitly so every rank is bound to its own GPU before Accelerate wraps
+    # the model in DistributedDataParallel.
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1 and not torch.distributed.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", "0")))
+        torch.distributed.init_process_group("nccl" if torch.cuda.is_available() else "gloo")
+    mixed_precision = args.mixed_precision
+    if mixed_precision == "auto":
+        if torch.cuda.is_available():
+            # bf16 on Ampere and newer; fp16 (with Accelerate's GradScaler) on Volta/Turing. is_bf16_supported()
+            # alone also reports True for the slow emulated bf16 on older GPUs.
+            bf16_native = torch.cuda.get_device_capability()[0] >= 8 and torch.cuda.is_bf16_supported()
+            mixed_precision = "bf16" if bf16_native else "fp16"
+        else:
+            mixed_precision = "no"
+    accelerator_kwargs = {
+        # Loss scaling, gradient sync and scheduler stepping for accumulation are all handled by Accelerate; the
+        # cycle also closes at the end of each epoch when the dataloader length is not a multiple of num_steps
+        "gradient_accumulation_plugin": GradientAccumulationPlugin(
+            num_steps=args.gradient_accumulation_steps, adjust_scheduler=True, sync_with_dataloader=True
+        ),
+        "mixed_precision": mixed_precision,
+        "kwargs_handlers": [ddp_kwargs],
+        # The prepared dataloaders move each batch to the GPU themselves; with pinned host memory the copy can be
+        # issued non-blocking so it overlaps with the compute still queued from the previous step
+        "dataloader_config": DataLoaderConfiguration(non_blocking=torch.cuda.is_available()),
+    }
+    if args.cuda_graphs:
+        # Cached autocast casts are freed when the autocast region exits, but a captured graph keeps reading them
+        accelerator_kwargs["kwargs_handlers"].append(AutocastKwargs(cache_enabled=False))
+    if args.with_tracking:
+        accelerator_kwargs.update(log_with=args.report_to, project_dir=args.output_dir)
+    accelerator = Accelerator(**accelerator_kwargs)
+    if args.cuda_graphs and (
+        accelerator.device.type != "cuda" or accelerator.num_processes > 1 or accelerator.mixed_precision == "fp16"
+    ):
+        # fp16 loss scaling may skip steps, which a replayed graph cannot do
+        raise ValueError("`--cuda_graphs` requires a single CUDA process without fp16 mixed precision.")
     # Make one log on every process with the configuration for debugging.
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s - %(message)s",
@@ -561,11 +864,12 @@ def main():
             os.makedirs(args.output_dir, exist_ok=True)
     accelerator.wait_for_everyone()
 
-    if not os.path.exists(dataset_path):
+    # Try the offline copy first; only fall back to the Hub when it has never been saved
+    try:
+        raw_datasets = datasets.load_from_disk(dataset_path)
+    except FileNotFoundError:
         raw_datasets = load_dataset("nyu-mll/glue", args.task_name)
         raw_datasets.save_to_disk(dataset_path)
-    else:
-        raw_datasets = datasets.load_from_disk(dataset_path)
 
     # Labels
     if args.task_name is not None:
@@ -625,7 +929,16 @@ def main():
 
 
     num_models = 3
-    models = [copy.deepcopy(model) for _ in range(num_models)]
+    # The loaded model is reused as the first member, so only num_models - 1 copies are made.
+    # Copies are built from the config and loaded from a state dict, which avoids deepcopy's
+    # recursive walk over the module tree.
+    state_dict = model.state_dict()
+    models = [model]
+    for _ in range(num_models - 1):
+        member = type(model)(copy.deepcopy(model.config))
+        member.load_state_dict(state_dict, strict=True)
+        models.append(member)
+    del state_dict
 
 
 
@@ -695,13 +1008,40 @@ def main():
                 result["labels"] = examples["label"]
         return result
 
+    # Tokenized datasets are cached next to the raw dataset so later runs skip tokenization
+    processed_path = os.path.join(
+        save_dir, f"tokenized_{model_name_short}_{args.task_name}_{args.max_length}_{padding}"
+    )
     with accelerator.main_process_first():
-        processed_datasets = raw_datasets.map(
-            preprocess_function,
-            batched=True,
-            remove_columns=raw_datasets["train"].column_names,
-            desc="Running tokenizer on dataset",
-        )
+        processed_datasets = None
+        if os.path.isdir(processed_path):
+            try:
+                processed_datasets = datasets.load_from_disk(processed_path)
+            except Exception as e:
+                # An unreadable cache (e.g. left incomplete by an older run) is treated as a miss
+                logger.warning(f"Ignoring unreadable tokenized cache {processed_path}: {e}")
+                if accelerator.is_main_process:
+                    shutil.rmtree(processed_path, ignore_errors=True)
+        if processed_datasets is None:
+            processed_datasets = raw_datasets.map(
+                preprocess_function,
+                batched=True,
+                batch_size=4000,
+                num_proc=min(8, os.cpu_count()),
+                load_from_cache_file=True,
+                remove_columns=raw_datasets["train"].column_names,
+                desc="Running tokenizer on dataset",
+            )
+            if accelerator.is_main_process:
+                # Seeds run in parallel share this cache: write to a private directory and rename it into place,
+                # so other runs never load a half-written cache
+                tmp_path = f"{processed_path}.tmp-{uuid.uuid4().hex}"
+                processed_datasets.save_to_disk(tmp_path)
+                try:
+                    os.replace(tmp_path, processed_path)
+                except OSError:
+                    # Another run published its cache first; keep that one
+                    shutil.rmtree(tmp_path, ignore_errors=True)
 
     train_dataset = processed_datasets["train"]
     eval_dataset = processed_datasets["validation_matched" if args.task_name == "mnli" else "validation"]
@@ -715,31 +1055,70 @@ def main():
         # If padding was already done ot max length, we use the default data collator that will just convert everything
         # to tensors.
         data_collator = default_data_collator
+    elif args.compile or args.cuda_graphs:
+        # A compiled forward or a CUDA graph needs static shapes, otherwise every new sequence length triggers a recompilation.
+        data_collator = DataCollatorWithPadding(tokenizer, padding="max_length", max_length=args.max_length)
     else:
         # Otherwise, `DataCollatorWithPadding` will apply dynamic padding for us (by padding to the maximum length of
-        # the samples passed). When using mixed precision, we add `pad_to_multiple_of=8` to pad all tensors to multiple
-        # of 8s, which will enable the use of Tensor Cores on NVIDIA hardware with compute capability >= 7.5 (Volta).
-        data_collator = DataCollatorWithPadding(tokenizer, pad_to_multiple_of=(8 if accelerator.use_fp16 else None))
+        # the samples passed). When using mixed precision (fp16 or bf16), we add `pad_to_multiple_of=8` to pad all
+        # tensors to multiple of 8s, which will enable the use of Tensor Cores on NVIDIA hardware with compute
+        # capability >= 7.5 (Volta).
+        data_collator = DataCollatorWithPadding(
+            tokenizer, pad_to_multiple_of=(8 if accelerator.mixed_precision in ("fp16", "bf16") else None)
+        )
+
+    # Collate in background workers and pin host memory so batches are ready (and copied asynchronously)
+    # while the GPU is busy with the previous step
+    dataloader_kwargs = {"num_workers": args.dataloader_num_workers, "pin_memory": torch.cuda.is_available()}
+    if args.dataloader_num_workers > 0:
+        dataloader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    # Length-grouped sampling keeps sequences of similar length together so dynamic padding wastes less compute.
+    # It has no effect when every sample is already padded to `max_length`.
+    train_sampler = None
+    if args.group_by_length and not args.pad_to_max_length:
+        # Every rank shards the same permutation, so the sampler gets its own identically seeded generator
+        # instead of the process-global RNG
+        train_sampler = LengthGroupedSampler(
+            args.per_device_train_batch_size,
+            lengths=[len(input_ids) for input_ids in train_dataset["input_ids"]],
+            generator=torch.Generator().manual_seed(args.seed if args.seed is not None else 0),
+        )
 
     train_dataloader = DataLoader(
-        train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size
+        train_dataset,
+        shuffle=train_sampler is None,
+        sampler=train_sampler,
+        collate_fn=data_collator,
+        batch_size=args.per_device_train_batch_size,
+        # A captured CUDA graph replays a fixed batch size
+        drop_last=args.cuda_graphs,
+        **dataloader_kwargs,
+    )
+    eval_dataloader = DataLoader(
+        eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size, **dataloader_kwargs
     )
-    eval_dataloader = DataLoader(eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size)
 
     # Optimizer
     # Split weights in two groups, one with weight decay and the other not
 
     ''' Ensemble model '''
-    ensemble_model = EnsembleModel(models,config)
+    # Layers whose attention maps are decorrelated across members
+    select_layers = args.select_layers #e.g. range(1,3)
+    ensemble_model = EnsembleModel(models,config, return_attentions=len(select_layers) > 0)
 
     no_decay = ["bias", "LayerNorm.weight"]
+    # Split the parameters in a single pass over the ensemble
+    decay_params, no_decay_params = [], []
+    for n, p in ensemble_model.named_parameters():
+        (no_decay_params if any(nd in n for nd in no_decay) else decay_params).append(p)
     optimizer_grouped_parameters = [
         {
-            "params": [p for n, p in ensemble_model.named_parameters() if not any(nd in n for nd in no_decay)],
+            "params": decay_params,
             "weight_decay": args.weight_decay,
         },
         {
-            "params": [p for n, p in ensemble_model.named_parameters() if any(nd in n for nd in no_decay)],
+            "params": no_decay_params,
             "weight_decay": 0.0,
         }
 
@@ -747,7 +1126,19 @@ def main():
 
     ''' Consolidator '''
     
-    optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+    if args.auto_scale:
+        # Linear scaling rule: the global batch grows with the number of processes, so does the learning rate
+        args.learning_rate = args.learning_rate * accelerator.num_processes
+
+    # On CUDA the fused AdamW kernel updates every parameter in a single launch. It checks the parameter
+    # devices at construction, so the ensemble is moved to the device first. Elsewhere use the foreach kernels.
+    if accelerator.device.type == "cuda":
+        ensemble_model.to(accelerator.device)
+        optimizer = torch.optim.AdamW(
+            optimizer_grouped_parameters, lr=args.learning_rate, fused=True, capturable=args.cuda_graphs
+        )
+    else:
+        optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=args.learning_rate, foreach=True)
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
@@ -756,10 +1147,15 @@ def main():
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
         overrode_max_train_steps = True
     
+    num_warmup_steps = args.num_warmup_steps
+    if args.auto_scale:
+        # The scaled learning rate is reached gradually
+        num_warmup_steps = max(num_warmup_steps, math.ceil(0.05 * args.max_train_steps))
+
     lr_scheduler = get_scheduler(
         name=args.lr_scheduler_type,
         optimizer=optimizer,
-        num_warmup_steps=args.num_warmup_steps,
+        num_warmup_steps=num_warmup_steps,
         num_training_steps=args.max_train_steps,
     )
     
@@ -768,9 +1164,35 @@ def main():
         ensemble_model, optimizer, train_dataloader, eval_dataloader, lr_scheduler
     )
 
+    if args.compile:
+        # Keep compiled kernels across runs so the compile cost is only paid once per configuration
+        os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(save_dir, "inductor_cache"))
+        # Batches are always padded to `max_length` when compiling, so the shapes are static and the
+        # step can be replayed as a CUDA graph. The same compiled forward serves training and evaluation.
+        # Member streams would split the compiled forward into several graphs; run the members in sequence
+        accelerator.unwrap_model(ensemble_model).use_streams = False
+        ensemble_model.forward = torch.compile(
+            ensemble_model.forward, mode="reduce-overhead", fullgraph=False, dynamic=False
+        )
+
+    cuda_graph_step = None
+    if args.cuda_graphs:
+        # Capture records the members one after another on the capture stream instead of across member streams
+        accelerator.unwrap_model(ensemble_model).use_streams = False
+        cuda_graph_step = CUDAGraphTrainStep(accelerator, ensemble_model, optimizer)
+
+
+    if args.auto_scale and not overrode_max_train_steps:
+        # An explicit step budget counts single-process steps; each step now covers `num_processes` times as many
+        # samples. The prepared scheduler advances `num_processes` times per step, so it still ends on time.
+        args.max_train_steps = math.ceil(args.max_train_steps / accelerator.num_processes)
+
+    # Lengths of the prepared dataloaders are fixed from here on, so look them up once
+    num_train_batches = len(train_dataloader)
+    num_eval_samples = len(eval_dataloader.dataset)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed
-    num_update_steps_per_epoch = math.ceil(len(train_dataloader) / args.gradient_accumulation_steps)
+    num_update_steps_per_epoch = math.ceil(num_train_batches / args.gradient_accumulation_steps)
     if overrode_max_train_steps:
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
     # Afterwards we recalculate our number of training epochs
@@ -830,110 +1252,117 @@ def main():
         else:
             # need to multiply `gradient_accumulation_steps` to reflect real steps
             resume_step = int(training_difference.replace("step_", "")) * args.gradient_accumulation_steps
-            starting_epoch = resume_step // len(train_dataloader)
+            starting_epoch = resume_step // num_train_batches
             completed_steps = resume_step // args.gradient_accumulation_steps
-            resume_step -= starting_epoch * len(train_dataloader)
+            resume_step -= starting_epoch * num_train_batches
 
     # update the progress_bar if load from checkpoint
     progress_bar.update(completed_steps)
     eval_result = None
+    # Checkpoints are written in the background while training continues
+    checkpointer = AsyncCheckpointer(accelerator)
+    # Step of the most recent checkpoint, so the same state is never serialized twice. Starting from the current
+    # step skips both an untrained `step_0` save and rewriting the checkpoint we just resumed from.
+    last_saved_step = completed_steps
     for epoch in range(starting_epoch, args.num_train_epochs):
 
         ensemble_model.train()
 
         if args.with_tracking:
-            total_loss = 0
+            # Accumulated on device; read back once per epoch when it is logged
+            total_loss = torch.zeros((), dtype=torch.float32, device=accelerator.device)
         if args.resume_from_checkpoint and epoch == starting_epoch and resume_step is not None:
             # We skip the first `n` batches in the dataloader when resuming from a checkpoint
             active_dataloader = accelerator.skip_first_batches(train_dataloader, resume_step)
         else:
             active_dataloader = train_dataloader
         for step, batch in enumerate(active_dataloader):
-            
-            outputs = ensemble_model(batch)
-            logits = outputs['combined_logits']
-            attentions = outputs['attentions']
+            # Gradients are only synchronized across processes on the last micro-batch of each accumulation cycle
+            with accelerator.accumulate(ensemble_model):
+                if cuda_graph_step is not None:
+                    # Forward, backward and optimizer step are replayed as one CUDA graph
+                    loss = cuda_graph_step(batch)
+                    if args.with_tracking:
+                        total_loss.add_(loss)
+                    lr_scheduler.step()
+                else:
+                    outputs = ensemble_model(**batch)
+                    logits = outputs['combined_logits']
+                    attentions = outputs['attentions']
             
             
-            loss = outputs['loss']
+                    loss = outputs['loss']
 
-            ''' Intermediate representation decorrelation'''
+                    ''' Intermediate representation decorrelation'''
             
-            select_layers = []#range(1,3)
-            
-            for layer_idx in select_layers:
-                
-                #Each attentions will contain n = number of models tuples
-                list_of_attentions = []
-                for model_idx,model_attentions in enumerate(attentions):
-                    list_of_attentions.append(model_attentions[layer_idx])
-                
-                similarity = n_cosine_similarity(list_of_attentions).mean()
-                loss += 0.1 * similarity
+                    if len(select_layers) > 0:
+                        #Each attentions will contain n = number of models tuples
+                        similarity = ensemble_attention_similarity(attentions, select_layers)
+                        loss += 0.1 * similarity.sum()
             
-            '''
+                    '''
 
-            for layer1,layer2 in zip(outputs_1.hidden_states,outputs_2.hidden_states):
-                #intermediate_act_1 = outputs_1.hidden_states[6]
-                #intermediate_act_2 = outputs_2.hidden_states[6]
-                #similarity = cosine_similarity(intermediate_act_1, intermediate_act_2).mean()
+                    for layer1,layer2 in zip(outputs_1.hidden_states,outputs_2.hidden_states):
+                        #intermediate_act_1 = outputs_1.hidden_states[6]
+                        #intermediate_act_2 = outputs_2.hidden_states[6]
+                        #similarity = cosine_similarity(intermediate_act_1, intermediate_act_2).mean()
                 
-                if (idx in select_layers):
-                    similarity = cosine_similarity(layer1,layer2).mean()#kl_convergence(layer1,layer2)
-                    loss += 0.1 * similarity
+                        if (idx in select_layers):
+                            similarity = cosine_similarity(layer1,layer2).mean()#kl_convergence(layer1,layer2)
+                            loss += 0.1 * similarity
 
-                idx += 1
-            '''
+                        idx += 1
+                    '''
 
-            # We keep track of the loss at each epoch
-            if args.with_tracking:
-                total_loss += loss.detach().float()
-            loss = loss / args.gradient_accumulation_steps
+                    # We keep track of the loss at each epoch
+                    if args.with_tracking:
+                        total_loss.add_(loss.detach())
             
-            accelerator.backward(loss)
+                    accelerator.backward(loss)
             
-            if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
-                #print(consolidated_logits[0])    
-                #print(f"Gradient Norms at step {step}: Model 1: {gradient_norm_1}, Model 2: {gradient_norm_2}, Consolidator: {gradient_norm_consolidator}")
-                optimizer.step()
+                    # Only touch the optimizer at the end of an accumulation cycle
+                    if accelerator.sync_gradients:
+                        #print(consolidated_logits[0])    
+                        #print(f"Gradient Norms at step {step}: Model 1: {gradient_norm_1}, Model 2: {gradient_norm_2}, Consolidator: {gradient_norm_consolidator}")
+                        optimizer.step()
 
-                lr_scheduler.step()
+                        lr_scheduler.step()
 
-                optimizer.zero_grad()
+                        optimizer.zero_grad(set_to_none=True)
 
+            # Checks if the accelerator has performed an optimization step behind the scenes
+            if accelerator.sync_gradients:
                 progress_bar.update(1)
                 completed_steps += 1
 
             if isinstance(checkpointing_steps, int):
-                if completed_steps % checkpointing_steps == 0:
+                # Checked on every micro-batch, so guard against saving the same step once per micro-batch
+                if completed_steps % checkpointing_steps == 0 and completed_steps != last_saved_step:
                     output_dir = f"step_{completed_steps}"
                     if args.output_dir is not None:
                         output_dir = os.path.join(args.output_dir, output_dir)
-                    accelerator.save_state(output_dir)
+                    checkpointer.save(output_dir, ensemble_model, optimizer, lr_scheduler)
+                    last_saved_step = completed_steps
 
             if completed_steps >= args.max_train_steps:
                 break
 
         ensemble_model.eval()
-        samples_seen = 0
+        logits_list, labels_list = [], []
         for step, batch in enumerate(eval_dataloader):
-            with torch.no_grad():
-                outputs = ensemble_model(batch)
-                logits = outputs['combined_logits']
-            
-            predictions = logits.argmax(dim=-1) if not is_regression else logits.squeeze()
-            predictions, references = accelerator.gather((predictions, batch["labels"]))
-            # If we are in a multiprocess environment, the last batch has duplicates
-            if accelerator.num_processes > 1:
-                if step == len(eval_dataloader) - 1:
-                    predictions = predictions[: len(eval_dataloader.dataset) - samples_seen]
-                    references = references[: len(eval_dataloader.dataset) - samples_seen]
-                else:
-                    samples_seen += references.shape[0]
-            metric.add_batch(
-                predictions=predictions,
-                references=references,
-            )
+            with torch.inference_mode():
+                outputs = ensemble_model(**batch)
+                # Clone: CUDA-graph replays under --compile reuse the output buffers
+                logits_list.append(outputs['combined_logits'].detach().clone())
+                labels_list.append(batch["labels"])
+
+        predictions, references = gather_eval_predictions(
+            accelerator, logits_list, labels_list, num_eval_samples, is_regression
+        )
+        metric.add_batch(
+            predictions=predictions,
+            references=references,
+        )
 
         eval_metric = compute_with_retry(metric)
         eval_result = eval_metric
@@ -943,7 +1372,7 @@ def main():
             accelerator.log(
                 {
                     "accuracy" if args.task_name is not None else "glue": eval_metric,
-                    "train_loss": total_loss.item() / len(train_dataloader),
+                    "train_loss": total_loss.item() / num_train_batches,
                     "epoch": epoch,
                     "step": completed_steps,
                 },
@@ -951,31 +1380,40 @@ def main():
             )
 
 
-        if args.checkpointing_steps == "epoch":
+        if args.checkpointing_steps == "epoch" and completed_steps != last_saved_step:
             output_dir = f"epoch_{epoch}"
             if args.output_dir is not None:
                 output_dir = os.path.join(args.output_dir, output_dir)
-            accelerator.save_state(output_dir)
+            checkpointer.save(output_dir, ensemble_model, optimizer, lr_scheduler)
+            last_saved_step = completed_steps
+    # Make sure the last checkpoint is fully written before moving on
+    checkpointer.wait(shutdown=True)
     
     folder_path = f"./saves/{args.job_id}"
     
     pathlib.Path(folder_path).mkdir(exist_ok=True)
     eval_save_file_name = f"{folder_path}/results_rg_{args.task_name}_{args.model_name_or_path.split('/')[-1]}.json"
-    if(not os.path.isfile(eval_save_file_name)):
-
-        #Custom save
-        json.dump(
-            {},
-            open(eval_save_file_name,'w')
-        ) 
-    
-    save_data = json.load(open(eval_save_file_name,'r'))
-    save_data[str(args.seed)] = eval_result
-    
-    json.dump(
-        save_data,
-        open(eval_save_file_name,'w')
-    )
+    if accelerator.is_main_process:
+        # Many seeds append to the same results file concurrently: serialise the read-modify-write with an
+        # exclusive lock and swap the new contents in atomically, so a crash never leaves a truncated file.
+        # The lock lives in a sidecar file because os.replace gives the results file a new inode.
+        with open(eval_save_file_name + ".lock", "w") as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                save_data = {}
+                if os.path.isfile(eval_save_file_name):
+                    with open(eval_save_file_name, "r") as f:
+                        save_data = json.load(f)
+                save_data[str(args.seed)] = eval_result
+
+                tmp_file_name = eval_save_file_name + ".tmp"
+                with open(tmp_file_name, "w") as f:
+                    json.dump(save_data, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file_name, eval_save_file_name)
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
 
     if args.with_tracking:
         accelerator.end_training()
@@ -1002,21 +1440,25 @@ def main():
         # Final evaluation on mismatched validation set
         eval_dataset = processed_datasets["validation_mismatched"]
         eval_dataloader = DataLoader(
-            eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size
+            eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size, **dataloader_kwargs
         )
         eval_dataloader = accelerator.prepare(eval_dataloader)
 
         ensemble_model.eval()
+        logits_list, labels_list = [], []
         for step, batch in enumerate(eval_dataloader):
-            outputs = ensemble_model(**batch)
-
-            logits = outputs.logits
+            with torch.inference_mode():
+                outputs = ensemble_model(**batch)
+                logits_list.append(outputs['combined_logits'].detach().clone())
+                labels_list.append(batch["labels"])
 
-            predictions = logits.argmax(dim=-1)
-            metric.add_batch(
-                predictions=accelerator.gather(predictions),
-                references=accelerator.gather(batch["labels"]),
-            )
+        predictions, references = gather_eval_predictions(
+            accelerator, logits_list, labels_list, len(eval_dataloader.dataset)
+        )
+        metric.add_batch(
+            predictions=predictions,
+            references=references,
+        )
 
         eval_metric = compute_with_retry(metric)
         logger.info(f"mnli-mm: {eval_metric}")
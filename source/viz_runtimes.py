@@ -1,51 +1,43 @@
+import glob
 import json
 import os
+import re
 import matplotlib.pyplot as plt
-import numpy as np
+import pandas as pd
+
+# coarse_time_m<model>_t<task>_o<optimizer>_e<epochs>.json
+FILENAME_PATTERN = re.compile(r"coarse_time_m([^_]+)_t([^_]+)_o([^_]+)_e(\d+)\.json")
 
 # Function to read JSON files and extract time_per_batch
 def read_json_files(directory):
-    data = {}
-    for filename in os.listdir(directory):
-        if filename.startswith("coarse_time_m") and filename.endswith(".json"):
-            parts = filename[:-5].split("_")
-            model = parts[2][1:]
-            task = parts[3][1:]
-            optimizer = parts[4][1:]
-            epochs = int(parts[5][1:])
-            
-            with open(os.path.join(directory, filename), 'r') as f:
-                file_data = json.load(f)
-                time_per_batch = file_data["time_per_batch"]
-                
-            if model not in data:
-                data[model] = {}
-            if task not in data[model]:
-                data[model][task] = {}
-            if optimizer not in data[model][task]:
-                data[model][task][optimizer] = {}
-            
-            data[model][task][optimizer][epochs] = time_per_batch
-    
-    return data
+    rows = []
+    for path in glob.glob(os.path.join(directory, "coarse_time_m*.json")):
+        match = FILENAME_PATTERN.fullmatch(os.path.basename(path))
+        if match is None:
+            continue
+        model, task, optimizer, epochs = match.groups()
 
-# Read data from JSON files
-data = read_json_files("saves")
+        with open(path, 'r') as f:
+            time_per_batch = json.load(f)["time_per_batch"]
 
-# Prepare data for plotting
-models = list(data.keys())
-tasks = list(data[models[0]].keys())
-optimizers = list(data[models[0]][tasks[0]].keys())
-epochs = list(data[models[0]][tasks[0]][optimizers[0]].keys())
+        rows.append({
+            "model": model,
+            "task": task,
+            "optimizer": optimizer,
+            "epochs": int(epochs),
+            "time_per_batch": time_per_batch,
+        })
 
-# Set up the plot
-fig, ax = plt.subplots(figsize=(12, 6))
+    return pd.DataFrame(rows, columns=["model", "task", "optimizer", "epochs", "time_per_batch"])
+
+# Read data from JSON files
+df = read_json_files("saves")
 
-# Set the width of each bar and the positions of the bars
-bar_width = 0.8 / len(optimizers)
-r = np.arange(len(models))
+# Plot a single task / epoch setting, as before
+task = df["task"].iloc[0]
+epochs = df["epochs"].iloc[0]
+df = df[(df["task"] == task) & (df["epochs"] == epochs)]
 
-# Plot bars for each optimizer
 optimizer_name_formating = {
     'adadelta': 'Adadelta',
     'adagrad' : 'AdaGrad',
@@ -56,18 +48,20 @@ optimizer_name_formating = {
     'rmsprop' : 'RMSprop',
     'agni'    : 'AdamW + AGNI'
 }
-print(data)
-for i, optimizer in enumerate(optimizers):
-    times = [data[model][tasks[0]][optimizer][epochs[0]] for model in models]
-    pos = r + i * bar_width
-    ax.bar(pos, times, width=bar_width, label= optimizer_name_formating[optimizer] if optimizer != "agni" else "AdamW + AGNI")
+print(df)
+
+# One group of bars per model, one bar per optimizer
+times = df.pivot_table(index="model", columns="optimizer", values="time_per_batch")
+times = times.rename(columns=optimizer_name_formating)
+
+fig, ax = plt.subplots(figsize=(12, 6))
+times.plot.bar(ax=ax, width=0.8)
 
 # Customize the plot
 ax.set_xlabel('Models', fontsize=12)
 ax.set_ylabel('Time per Batch (seconds)', fontsize=12)
-ax.set_title(f'Comparison of Time per Batch for Different Optimizers\n(Task: {tasks[0]}, Epochs: {epochs[0]})', fontsize=14)
-ax.set_xticks(r + bar_width * (len(optimizers) - 1) / 2)
-ax.set_xticklabels(models, rotation=45, ha='right')
+ax.set_title(f'Comparison of Time per Batch for Different Optimizers\n(Task: {task}, Epochs: {epochs})', fontsize=14)
+ax.set_xticklabels(times.index, rotation=45, ha='right')
 ax.legend(title='Optimizers', bbox_to_anchor=(1.05, 1), loc='upper left')
 
 plt.tight_layout()
@@ -0,0 +1,67 @@
+import copy
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("accelerate")
+transformers = pytest.importorskip("transformers")
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "source"))
+
+pytestmark = pytest.mark.skipif(not torch.cuda.is_available(), reason="CUDA graphs need a GPU")
+
+
+def test_cuda_graph_step_matches_eager():
+    # Smoke test for --cuda_graphs: the warmup, captured and replayed steps give the same losses as eager training
+    from accelerate import Accelerator
+    from accelerate.utils import AutocastKwargs
+
+    from run_glue_baselines2 import CUDAGraphTrainStep, EnsembleModel
+
+    bf16 = torch.cuda.get_device_capability()[0] >= 8 and torch.cuda.is_bf16_supported()
+    accelerator = Accelerator(
+        mixed_precision="bf16" if bf16 else "no", kwargs_handlers=[AutocastKwargs(cache_enabled=False)]
+    )
+
+    torch.manual_seed(0)
+    config = transformers.BertConfig(
+        vocab_size=128,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+        hidden_dropout_prob=0.0,
+        attention_probs_dropout_prob=0.0,
+        num_labels=2,
+    )
+    members = [transformers.BertForSequenceClassification(config) for _ in range(2)]
+    eager_model = EnsembleModel(members, config).to(accelerator.device)
+    graph_model = copy.deepcopy(eager_model)
+    graph_model.use_streams = False
+
+    eager_optimizer = torch.optim.AdamW(eager_model.parameters(), lr=1e-3, fused=True)
+    graph_optimizer = torch.optim.AdamW(graph_model.parameters(), lr=1e-3, fused=True, capturable=True)
+    eager_model, eager_optimizer, graph_model, graph_optimizer = accelerator.prepare(
+        eager_model, eager_optimizer, graph_model, graph_optimizer
+    )
+    graph_step = CUDAGraphTrainStep(accelerator, graph_model, graph_optimizer, warmup_steps=3)
+
+    for _ in range(8):
+        batch = {
+            "input_ids": torch.randint(0, 128, (4, 16), device=accelerator.device),
+            "attention_mask": torch.ones(4, 16, dtype=torch.long, device=accelerator.device),
+            "token_type_ids": torch.zeros(4, 16, dtype=torch.long, device=accelerator.device),
+            "labels": torch.randint(0, 2, (4,), device=accelerator.device),
+        }
+        eager_optimizer.zero_grad(set_to_none=True)
+        eager_loss = eager_model(**batch)["loss"]
+        accelerator.backward(eager_loss)
+        eager_optimizer.step()
+
+        graph_loss = graph_step(batch)
+        tolerance = 2e-2 if bf16 else 1e-4
+        torch.testing.assert_close(graph_loss.float(), eager_loss.detach().float(), rtol=tolerance, atol=tolerance)
+
+    assert graph_step.graph is not None